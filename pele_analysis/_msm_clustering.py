@@ -1,14 +1,28 @@
 try:
     import pyemma
+    from pyemma.coordinates.data import DataInMemory
 except ImportError as e:
     raise ValueError('pyemma python module not avaiable. Please install it to use this function.')
 
+try:
+    import numba
+    from numba import njit, prange
+except ImportError as e:
+    numba = None
+
+import os
+import shutil
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import mdtraj as md
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import itertools
-from scipy.ndimage import gaussian_filter
+import functools
+from scipy.ndimage import convolve1d
+from scipy.signal import windows
 from ipywidgets import interact, fixed #FloatSlider, IntSlider, FloatRangeSlider, VBox, HBox, interactive_output, Dropdown, Checkbox
 from pyemma.util.contexts import settings
 
@@ -33,10 +47,22 @@ class ligand_msm:
         self.all_tica = {}
         self.all_tica_output = {}
         self.all_tica_concatenated = {}
+        self.all_tica_columns = {}
+        self.tica_columns = {}
         self.metric_features = {}
         self.metrics_concatenated = {}
         self.kmeans_clusters = {}
 
+        # Row indexes (in frame order) of each trajectory by (protein, ligand), sorted by
+        # trajectory. The shared data frame is not reordered, since pele_analysis
+        # assigns new metric columns by row position.
+        self._traj_index = {}
+        indices = self.pele_analysis.data.groupby(level=['Protein', 'Ligand', 'Trajectory']).indices
+        for protein, ligand, trajectory in sorted(indices):
+            self._traj_index.setdefault((protein, ligand), []).append(indices[(protein, ligand, trajectory)])
+
+        self._ic_labels = ()
+
         # Get individual ligand-only trajectories
         print('Getting individual ligand trajectories')
         for protein, ligand in self.pele_analysis.pele_combinations:
@@ -45,18 +71,21 @@ class ligand_msm:
 
             self.trajectories[(protein, ligand)], self.topology[protein][ligand] = self.pele_analysis.getLigandTrajectoryPerTrajectory(protein, ligand, return_paths=True)
 
-            # Gather all trajectories
-            for t in self.trajectories[(protein, ligand)]:
-                self.all_trajectories.append(t)
+        # Load each ligand topology only once (no coordinates are needed)
+        for protein, ligand in self.pele_analysis.pele_combinations:
+            if ligand in self.ligand_atoms:
+                continue
+            top = md.load_topology(self.topology[protein][ligand])
 
             # Get ligand atom names
-            if ligand not in self.ligand_atoms:
-                top_traj = md.load(self.topology[protein][ligand])
-                self.ligand_atoms[ligand] = [a.name for a in top_traj.topology.atoms]
+            self.ligand_atoms[ligand] = tuple(a.name for a in top.atoms)
 
             # Create featurizer
-            if ligand not in self.features:
-                self.features[ligand] = pyemma.coordinates.featurizer(self.topology[protein][ligand])
+            self.features[ligand] = pyemma.coordinates.featurizer(top)
+
+        # Gather all trajectories
+        self.all_trajectories = list(itertools.chain.from_iterable(self.trajectories[(protein, ligand)]
+                                     for protein, ligand in self.pele_analysis.pele_combinations))
 
     def addFeature(self, feature, ligand, only_metrics=None):
         """
@@ -86,80 +115,229 @@ class ligand_msm:
 
             # Get metrics
             metrics = []
-            for m in self.pele_analysis.data.keys():
-                if m.startswith('metric_'):
-                    if only_metrics and m.replace('metric_', '') not in only_metrics:
-                        continue
-                    metrics.append(m)
+            for m in self._metricColumns():
+                if only_metrics and m.replace('metric_', '') not in only_metrics:
+                    continue
+                metrics.append(m)
 
             # Get metrics data
-            ligand_data = self.pele_analysis.data[self.pele_analysis.data.index.get_level_values('Ligand') == ligand]
             for protein in self.pele_analysis.proteins:
-
                 # Add metric features to ligand
                 if protein not in self.metric_features[ligand]:
                     self.metric_features[ligand][protein] = []
 
-                protein_data = ligand_data[ligand_data.index.get_level_values('Protein') == protein]
-                for trajectory in ligand_data.index.levels[3]:
-                    trajectory_data = protein_data[protein_data.index.get_level_values('Trajectory') == trajectory]
-                    self.metric_features[ligand][protein].append(trajectory_data[metrics].to_numpy())
+            metric_values = self.pele_analysis.data[metrics].to_numpy(dtype=np.float32)
+            for protein in self.metric_features[ligand]:
+                for rows in self._traj_index.get((protein, ligand), []):
+                    self.metric_features[ligand][protein].append(metric_values[rows])
+
+            # Get concatenated metric vectors
+            for protein in self.metric_features[ligand]:
+                if self.metric_features[ligand][protein] != []:
+                    self.metrics_concatenated[ligand][protein] = np.concatenate(self.metric_features[ligand][protein])
 
-                # Get concatenated metric vectors
-                metrics_concatenated = []
-                for t in self.metric_features[ligand][protein]:
-                    metrics_concatenated.append(t)
-                self.metrics_concatenated[ligand][protein] = np.concatenate(metrics_concatenated)
+    def _metricColumns(self):
+        """
+        Get the metric columns currently present in the PELE data.
+        """
+        return [c for c in self.pele_analysis.data.columns if c.startswith('metric_')]
 
-    def getFeaturesData(self, ligand):
+    def getFeaturesData(self, ligand, use_cache=True):
         """
+        Load the featurized ligand trajectories for all proteins.
+
+        Parameters
+        ==========
+        ligand : str
+            Name of the ligand
+        use_cache : bool
+            Read and store featurized trajectories from the feature cache folder
+            inside the pele analysis data folder. Cached trajectories are memory
+            mapped, so they are streamed from disk instead of being held in memory.
+            Metric features are joined to them chunk by chunk when read.
         """
         if ligand not in self.data:
             self.data[ligand] = {}
 
-        if ligand not in self.all_data:
-            self.all_data[ligand] = []
-
         for protein in self.pele_analysis.proteins:
 
-            self.data[ligand][protein] = pyemma.coordinates.load(self.trajectories[(protein, ligand)], features=self.features[ligand])
+            self.data[ligand][protein] = []
+            for trajectory in self.trajectories[(protein, ligand)]:
+                # Single precision is enough for TICA and halves the memory traffic
+                load = lambda: pyemma.coordinates.load(trajectory, features=self.features[ligand]).astype(np.float32, copy=False)
+                if use_cache:
+                    traj_data = self._cachedFeatures(protein, ligand, trajectory, load)
+                else:
+                    traj_data = load()
+                self.data[ligand][protein].append(traj_data)
 
-            # Add metric features
+            # Add metric features (only the raw features are cached on disk, so they
+            # are joined lazily to keep the feature arrays memory mapped)
             if ligand in self.metric_features:
                 for t in range(len(self.metric_features[ligand][protein])):
 
                     assert self.metric_features[ligand][protein][t].shape[0] == self.data[ligand][protein][t].shape[0]
 
-                    self.data[ligand][protein][t] = np.concatenate([self.data[ligand][protein][t],
-                                                    self.metric_features[ligand][protein][t]],
-                                                    axis=1)
-            self.all_data[ligand] += self.data[ligand][protein]
+                    self.data[ligand][protein][t] = _JoinedTrajectory(self.data[ligand][protein][t],
+                                                                      self.metric_features[ligand][protein][t])
+
+        # Only references to the per-trajectory arrays are gathered here
+        self.all_data[ligand] = list(itertools.chain.from_iterable(self.data[ligand][protein]
+                                     for protein in self.pele_analysis.proteins))
 
-    def calculateTICA(self, ligand, lag_time, dim=-1):
+    def _cachedFeatures(self, protein, ligand, trajectory, compute):
         """
+        Load a memory mapped featurized trajectory from the feature cache, computing
+        and storing it with the compute function if not found.
+
+        Cache files are named after the trajectory and topology paths, the active
+        featurizer descriptors and the dtype, plus a key combining the trajectory
+        modification time and first bytes, so adding new features never returns stale
+        data. Only one file is kept per trajectory and feature set: entries whose
+        trajectory content changed are removed when a new one is stored. Files are written to a temporary name first, so
+        interrupted runs never leave truncated entries.
+        """
+
+        cache_folder = self.pele_analysis.data_folder+'/feature_cache'
+        if not os.path.exists(cache_folder):
+            os.mkdir(cache_folder)
+
+        name = hashlib.sha1()
+        name.update(os.path.abspath(trajectory).encode())
+        name.update(os.path.abspath(self.topology[protein][ligand]).encode())
+        name.update('\n'.join(self.features[ligand].describe()).encode())
+        name.update(np.dtype(np.float32).str.encode())
+
+        key = hashlib.sha1()
+        key.update(str(os.path.getmtime(trajectory)).encode())
+        with open(trajectory, 'rb') as tf:
+            key.update(tf.read(4096))
+
+        prefix = name.hexdigest()+'_'
+        cache_file = cache_folder+'/'+prefix+key.hexdigest()+'.npy'
+
+        if not os.path.exists(cache_file):
+            fd, tmp_file = tempfile.mkstemp(dir=cache_folder, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as tf:
+                    np.save(tf, compute())
+                os.replace(tmp_file, cache_file)
+            except BaseException:
+                os.remove(tmp_file)
+                raise
+
+            # Remove outdated entries of the same trajectory
+            for f in os.listdir(cache_folder):
+                if f.startswith(prefix) and cache_folder+'/'+f != cache_file:
+                    os.remove(cache_folder+'/'+f)
+
+        return np.load(cache_file, mmap_mode='r')
+
+    def clearFeatureCache(self):
+        """
+        Remove all featurized trajectories stored in the feature cache folder.
+        """
+        cache_folder = self.pele_analysis.data_folder+'/feature_cache'
+        if os.path.exists(cache_folder):
+            shutil.rmtree(cache_folder)
+
+    def calculateTICA(self, ligand, lag_time, dim=-1, n_jobs=-1, chunksize=5000):
+        """
+        Calculate TICA for all ligand simulations and project each protein+ligand
+        trajectory into it.
+
+        Parameters
+        ==========
+        ligand : str
+            Name of the ligand
+        lag_time : int
+            TICA lag time
+        dim : int
+            Number of TICA dimmensions to keep (-1 keeps 95% of the kinetic variance)
+        n_jobs : int
+            Number of threads used to project the trajectories into the TICA space
+            (-1 uses all available cores).
+        chunksize : int
+            Number of frames read at a time when estimating the TICA covariances
+        and projecting the trajectories.
         """
 
         # Create TICA based on all ligand simulations
-        self.all_tica[ligand] = pyemma.coordinates.tica(self.all_data[ligand], lag=lag_time, dim=dim)
-        self.all_tica_output[ligand] = self.all_tica[ligand].get_output()
-        self.all_tica_concatenated[ligand] = np.concatenate(self.all_tica_output[ligand])
-        self.ndims = self.all_tica_concatenated[ligand].shape[1]
+        self.all_tica[ligand] = self._fit_tica(ligand, lag_time, dim=dim, chunksize=chunksize)
+        self._apply_tica(ligand, n_jobs=n_jobs, chunksize=chunksize)
+
+    def _fit_tica(self, ligand, lag_time, dim=-1, var_cutoff=0.95, chunksize=5000):
+        """
+        Fit a TICA estimator on all ligand simulations without transforming the data.
+        The covariances are estimated streaming over chunks of frames.
+        """
+        reader = _FeatureReader(self.all_data[ligand], chunksize=chunksize)
+        return pyemma.coordinates.tica(reader, lag=lag_time, dim=dim, var_cutoff=var_cutoff,
+                                       chunksize=chunksize)
+
+    def _apply_tica(self, ligand, n_jobs=-1, chunksize=5000):
+        """
+        Project the ligand simulations into the fitted TICA space.
+        """
+        self.ndims = self.all_tica[ligand].dimension()
+        self._ic_labels = tuple('IC'+str(i+1) for i in range(self.ndims))
 
         # Transorm individual protein+ligand trajectories into TICA mammping
         if ligand not in self.tica_output:
             self.tica_output[ligand] = {}
         if ligand not in self.tica_concatenated:
             self.tica_concatenated[ligand] = {}
-        for protein in self.data[ligand]:
-            self.tica_output[ligand][protein] = self.all_tica[ligand].transform(self.data[ligand][protein])
-            self.tica_concatenated[ligand][protein] = np.concatenate(self.tica_output[ligand][protein])
+        if ligand not in self.tica_columns:
+            self.tica_columns[ligand] = {}
+
+        # Project all trajectories into a single preallocated array
+        proteins = list(self.data[ligand])
+        projected = _projectTICA(self.all_tica[ligand], self.all_data[ligand], n_jobs=n_jobs,
+                                 chunksize=chunksize)
+        self.all_tica_concatenated[ligand] = projected
+
+        outputs = []
+        concatenated = []
+        offset = 0
+        for protein in proteins:
+            lengths = [t.shape[0] for t in self.data[ligand][protein]]
+            protein_projected = projected[offset:offset+sum(lengths)]
+            outputs.append(np.split(protein_projected, np.cumsum(lengths)[:-1]))
+            concatenated.append(protein_projected)
+            offset += sum(lengths)
+
+        self.all_tica_output[ligand] = list(itertools.chain.from_iterable(outputs))
+        self.all_tica_columns[ligand] = _splitColumns(self.all_tica_concatenated[ligand])
+
+        for protein, output, protein_concatenated in zip(proteins, outputs, concatenated):
+            self.tica_output[ligand][protein] = output
+            self.tica_concatenated[ligand][protein] = protein_concatenated
+            self.tica_columns[ligand][protein] = _splitColumns(self.tica_concatenated[ligand][protein])
+
+    def plotLagTimeVsTICADim(self, ligand, min_lag_time=1, max_lag_time=50, var_cutoff=0.95, chunksize=5000):
+        """
+        Plot the number of TICA dimmensions holding the given kinetic variance for a range of lag times.
+        For every lag time only the TICA fit is done; no data is transformed.
+
+        Parameters
+        ==========
+        ligand : str
+            Name of the ligand
+        min_lag_time : int
+            Minimum lag time to scan
+        max_lag_time : int
+            Maximum lag time to scan
+        var_cutoff : float
+            Fraction of the kinetic variance to keep.
+        chunksize : int
+            Number of frames read at a time when estimating the covariances.
+        """
 
-    def plotLagTimeVsTICADim(self, ligand, min_lag_time=1, max_lag_time=50):
         lag_times = []
         dims = []
         for lt in range(min_lag_time, max_lag_time+1):
-            self.calculateTICA(ligand,lt)
-            ndim = self.all_tica_concatenated[ligand].shape[1]
+            # The stored TICA attributes are left untouched
+            ndim = self._fit_tica(ligand, lt, var_cutoff=var_cutoff, chunksize=chunksize).dimension()
             lag_times.append(lt)
             dims.append(ndim)
 
@@ -167,7 +345,7 @@ class ligand_msm:
         Xa = np.array(lag_times)
         plt.plot(Xa,dims)
         plt.xlabel('Lag time [ns]', fontsize=12)
-        plt.ylabel('Nbr. of dimensions holding\n95% of the kinetic variance', fontsize=12)
+        plt.ylabel('Nbr. of dimensions holding\n%g%% of the kinetic variance' % (var_cutoff*100), fontsize=12)
 
     def plotTICADistribution(self, ligand, max_tica=10):
         """
@@ -180,38 +358,77 @@ class ligand_msm:
             ylog=True)
         fig.tight_layout()
 
-    def plotTICADensity(self, ligand, ndims=None):
+    def plotTICADensity(self, ligand, ndims=None, bins=100, ncontours=100):
         """
+        Plot the logscale density of all pairs of TICA dimmensions.
+
+        Parameters
+        ==========
+        ligand : str
+            Name of the ligand
+        ndims : int
+            Number of TICA dimmensions to combine
+        bins : int
+            Number of bins to divide each TICA dimmension
+        ncontours : int
+            Number of logscale contour levels
         """
 
         if ndims == None:
             ndims = self.ndims
 
+        # Bin each IC only once; all pairs share the same bin indexes
         IC = {}
+        centers = {}
         for i in range(ndims):
-            IC[i] = self.all_tica_concatenated[ligand][:, i]
+            column = self.all_tica_columns[ligand][i]
+            c_min, c_max = np.min(column), np.max(column)
+            width = (c_max-c_min)/bins
+            if width == 0:
+                width = 1.0
+            IC[i] = np.minimum(((column-c_min)/width).astype(np.int64), bins-1)
+            centers[i] = c_min+(np.arange(bins)+0.5)*width
 
         combinations = list(itertools.combinations(range(ndims), r=2))
+        H = np.empty((len(combinations), bins, bins))
+        for k,c in enumerate(combinations):
+            H[k] = np.bincount(IC[c[0]]*bins+IC[c[1]], minlength=bins*bins).reshape(bins, bins)
+        H /= H[0].sum()
+
         fig, axes = plt.subplots(len(combinations), figsize=(7, 5*len(combinations)), sharey=True, sharex=True)
+        if len(combinations) <= 1:
+            axes = [axes]
         for i,c in enumerate(combinations):
-            if len(combinations) <= 1:
-                pyemma.plots.plot_density(*np.array([IC[c[0]], IC[c[1]]]), ax=axes, logscale=True)
-                axes.set_xlabel('IC '+str(c[0]+1))
-                axes.set_ylabel('IC '+str(c[1]+1))
-            else:
-                pyemma.plots.plot_density(*np.array([IC[c[0]], IC[c[1]]]), ax=axes[i], logscale=True)
-                axes[i].set_xlabel('IC '+str(c[0]+1))
-                axes[i].set_ylabel('IC '+str(c[1]+1))
+            density = np.ma.masked_where(H[i] <= 0, H[i])
+            # Same logscale contour levels as pyemma.plots.plot_density
+            levels = np.logspace(np.floor(np.log10(density.min())), np.ceil(np.log10(density.max())),
+                                 ncontours+1)
+            pyemma.plots.plot_map(centers[c[0]], centers[c[1]], density.T, ax=axes[i], levels=levels,
+                                  ncontours=ncontours, norm=matplotlib.colors.LogNorm(),
+                                  cbar_label='sample density')
+            axes[i].set_xlabel('IC '+str(c[0]+1))
+            axes[i].set_ylabel('IC '+str(c[1]+1))
 
     def getMetricData(self, ligand, protein, metric):
         """
+        Get the per-trajectory values of a metric for a protein and ligand.
+
+        Parameters
+        ==========
+        ligand : str
+            Name of the ligand
+        protein : str
+            Name of the protein
+        metric : str
+            Name of the metric column
+
+        Returns
+        =======
+        metric_data : list
+            List of numpy arrays with the metric values of each trajectory.
         """
-        metric_data = []
-        ligand_data = self.pele_analysis.data[self.pele_analysis.data.index.get_level_values('Ligand') == ligand]
-        protein_data = ligand_data[ligand_data.index.get_level_values('Protein') == protein]
-        for trajectory in ligand_data.index.levels[3]:
-            trajectory_data = protein_data[protein_data.index.get_level_values('Trajectory') == trajectory]
-            metric_data.append(trajectory_data[metric].to_numpy())
+        metric_values = self.pele_analysis.data[metric].to_numpy()
+        metric_data = [metric_values[rows] for rows in self._traj_index[(protein, ligand)]]
 
         return metric_data
 
@@ -325,16 +542,15 @@ class ligand_msm:
                 avg_m = np.average(self.pele_analysis.data[m])
                 std_m = np.std(self.pele_analysis.data[m])
 
-                n_metric = (self.pele_analysis.getProteinAndLigandData(protein, ligand)[m]-avg_m)/std_m
+                n_metric = (self.pele_analysis.data[m].to_numpy()-avg_m)/std_m
 
                 # Add average and std to recover clustering coordinates
                 self.kmeans_metrics[ligand].append(m)
                 self.kmeans_metrics_conversion[ligand][protein][m] = (avg_m, std_m)
 
                 # Add metric columns to each trajectory separatedly
-                for i,t in enumerate(n_metric.index.levels[3]):
-                    traj_data = n_metric[n_metric.index.get_level_values('Trajectory') == t]
-                    traj_data = traj_data.to_numpy() # convert to numpy
+                for i,rows in enumerate(self._traj_index[(protein, ligand)]):
+                    traj_data = n_metric[rows]
                     traj_data = traj_data.reshape((traj_data.shape[0], 1)) # reshape for concatenation
                     data[i] = np.concatenate([data[i], traj_data], axis=1) # Paste with the clustering data
 
@@ -379,6 +595,9 @@ class ligand_msm:
             Do you want to plot clusters?
         """
 
+        # Metrics and TICA dimmensions to choose from
+        dimmensions = self._metricColumns() + list(self._ic_labels[:max_tica])
+
         def getLigands(Protein, max_tica=10, metric_line=None):
             ligands = []
             for protein, ligand in self.pele_analysis.pele_combinations:
@@ -396,42 +615,38 @@ class ligand_msm:
 
         def getCoordinates(Protein, Ligand, max_tica=10, metric_line=None):
 
-            if max_tica > self.ndims:
-                max_tica = self.ndims
-
-            dimmensions = []
-            # Add metrics
-            for m in self.pele_analysis.data.keys():
-                if m.startswith('metric_'):
-                    dimmensions.append(m)
-
-            # Add TICA dimmensions
-            for i in range(max_tica):
-                dimmensions.append('IC'+str(i+1))
-
             interact(_plotBindingEnergy, Protein=fixed(Protein), Ligand=fixed(Ligand), X=dimmensions, Y=dimmensions,
                      metric_line=fixed(metric_line))
 
+        def _getInputData(Protein, Ligand, dimmension):
+            if dimmension.startswith('IC'):
+                index = int(dimmension.replace('IC', ''))-1
+                return self.tica_columns[Ligand][Protein][index]
+            elif dimmension.startswith('metric_'):
+                return _concatenateTrajectories(self.getMetricData(Ligand, Protein, dimmension))
+
+        @functools.lru_cache(maxsize=None)
+        def _getFreeEnergySurface(Protein, Ligand, X, Y):
+            # Cache surfaces so changing between already seen X/Y pairs skips the histogram.
+            # The cache lives only as long as these widgets, so recomputed metrics are seen
+            # by calling plotFreeEnergy again.
+            input_data1 = _getInputData(Protein, Ligand, X)
+            input_data2 = _getInputData(Protein, Ligand, Y)
+            return _freeEnergySurface(input_data1, input_data2, bins=bins, sigma=sigma)
+
         def _plotBindingEnergy(Protein, Ligand, X='IC1', Y='IC2', metric_line=None):
 
-            if X.startswith('IC'):
-                index = int(X.replace('IC', ''))-1
-                input_data1 = self.tica_concatenated[Ligand][Protein][:, index]
-                x_metric_line = None
-            elif X.startswith('metric_'):
-                input_data1 = np.concatenate(self.getMetricData(Ligand, Protein, X))
+            x_metric_line = None
+            if X.startswith('metric_'):
                 x_metric_line = metric_line
 
-            if Y.startswith('IC'):
-                index = int(Y.replace('IC', ''))-1
-                input_data2 = self.tica_concatenated[Ligand][Protein][:, index]
-                y_metric_line = None
-            elif Y.startswith('metric_'):
-                input_data2 = np.concatenate(self.getMetricData(Ligand, Protein, Y))
+            y_metric_line = None
+            if Y.startswith('metric_'):
                 y_metric_line = metric_line
 
-            ax = _plot_Nice_PES(input_data1, input_data2, xlabel=X, ylabel=Y, bins=bins, size=size, sigma=sigma,
-                                x_metric_line=x_metric_line, y_metric_line=y_metric_line, xlim=xlim, ylim=ylim)
+            ax = _plot_Nice_PES(None, None, xlabel=X, ylabel=Y, bins=bins, size=size, sigma=sigma,
+                                x_metric_line=x_metric_line, y_metric_line=y_metric_line, xlim=xlim, ylim=ylim,
+                                surface=_getFreeEnergySurface(Protein, Ligand, X, Y))
 
             # Plot clusters if found
             while True: # Used for stoping if statments
@@ -471,36 +686,319 @@ class ligand_msm:
                         ax.scatter(cpx[mark_cluster], cpy[mark_cluster], c='r', s=10)
                 break
 
+            # Display and release the figure so widget updates do not accumulate them
+            plt.show()
+            plt.close(ax.figure)
+
         interact(getLigands, Protein=sorted(self.pele_analysis.proteins)+['all'], max_tica=fixed(max_tica),
                  metric_line=fixed(metric_line))
 
+def _concatenateTrajectories(arrays):
+    """
+    Concatenate a list of per-trajectory arrays along the first axis into a single
+    preallocated, C-contiguous array.
+
+    Parameters
+    ==========
+    arrays : list
+        List of numpy arrays with matching trailing dimensions.
+
+    Returns
+    =======
+    concatenated : numpy.ndarray
+        Array containing all the input arrays stacked along the first axis.
+    """
+
+    total = sum(a.shape[0] for a in arrays)
+    concatenated = np.empty((total,)+arrays[0].shape[1:], dtype=arrays[0].dtype)
+    offset = 0
+    for a in arrays:
+        n = a.shape[0]
+        concatenated[offset:offset+n] = a
+        offset += n
+
+    return np.ascontiguousarray(concatenated)
+
+def _projectTICA(tica, arrays, n_jobs=-1, chunksize=5000):
+    """
+    Project trajectories into a fitted TICA space, as pyemma's TICA transform does
+    for each chunk: (X-mean)*eigenvectors. The kinetic or commute map scaling is
+    already folded into the estimator eigenvectors. Each trajectory is projected
+    chunk by chunk directly into a single preallocated output array; trajectories
+    are distributed over threads, since numpy releases the GIL.
+
+    Parameters
+    ==========
+    tica : pyemma.coordinates.transform.TICA
+        Fitted TICA estimator.
+    arrays : list
+        List of featurized trajectories.
+    n_jobs : int
+        Number of threads (-1 uses all available cores).
+    chunksize : int
+        Number of frames of a trajectory projected at a time.
+
+    Returns
+    =======
+    projected : numpy.ndarray
+        Projected (float32) coordinates of all trajectories stacked along the first axis.
+    """
+
+    dim = tica.dimension()
+    V = tica.eigenvectors[:, :dim].astype(np.float32)
+    mean = tica.mean.astype(np.float32)
+
+    # Fill the output per trajectory, so no full copy of the (memory mapped) input is made
+    projected = np.empty((sum(a.shape[0] for a in arrays), dim), dtype=np.float32)
+    offsets = np.concatenate([[0], np.cumsum([a.shape[0] for a in arrays])])
+
+    def _project(i):
+        # Each trajectory writes to its own rows of the output
+        for start in range(0, arrays[i].shape[0], chunksize):
+            stop = min(start+chunksize, arrays[i].shape[0])
+            np.dot(arrays[i][start:stop]-mean, V, out=projected[offsets[i]+start:offsets[i]+stop])
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs > 1 and len(arrays) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(_project, range(len(arrays))))
+    else:
+        for i in range(len(arrays)):
+            _project(i)
+
+    return projected
+
+def _joinColumns(features, metrics):
+    """
+    Join the feature and metric columns of a trajectory into a single preallocated array.
+
+    Parameters
+    ==========
+    features : numpy.ndarray
+        2D array of trajectory features with shape (n_frames, n_features).
+    metrics : numpy.ndarray
+        2D array of trajectory metrics with shape (n_frames, n_metrics).
+
+    Returns
+    =======
+    joined : numpy.ndarray
+        Array with shape (n_frames, n_features+n_metrics).
+    """
+
+    n_features = features.shape[1]
+    joined = np.empty((features.shape[0], n_features+metrics.shape[1]),
+                      dtype=np.result_type(features, metrics))
+    joined[:, :n_features] = features
+    joined[:, n_features:] = metrics
+
+    return joined
+
+class _JoinedTrajectory:
+    """
+    Read-only view of a trajectory's feature and metric columns joined together.
+    Only the frames requested are joined, so (memory mapped) features are never
+    copied in full.
+
+    Parameters
+    ==========
+    features : numpy.ndarray
+        2D array of trajectory features with shape (n_frames, n_features).
+    metrics : numpy.ndarray
+        2D array of trajectory metrics with shape (n_frames, n_metrics).
+    """
+
+    ndim = 2
+
+    def __init__(self, features, metrics):
+        self.features = features
+        self.metrics = metrics
+        self.shape = (features.shape[0], features.shape[1]+metrics.shape[1])
+        self.dtype = np.result_type(features, metrics)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        dims = None
+        if isinstance(key, tuple):
+            key, dims = key
+        if isinstance(key, (int, np.integer)):
+            joined = np.concatenate([self.features[key], self.metrics[key]]).astype(self.dtype, copy=False)
+        else:
+            joined = _joinColumns(self.features[key], self.metrics[key])
+        if dims is not None:
+            joined = joined[..., dims]
+        return joined
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+class _FeatureReader(DataInMemory):
+    """
+    pyemma reader over featurized trajectories that may be memory mapped arrays or
+    _JoinedTrajectory views, so TICA is estimated reading them chunk by chunk.
+    """
+
+    __serialize_version = 0
+
+    def __init__(self, data, chunksize=None, **kw):
+        # Let pyemma set up the reader with the raw arrays, then swap in the views
+        super(_FeatureReader, self).__init__([getattr(d, 'features', d) for d in data],
+                                             chunksize=chunksize, **kw)
+        self._data = list(data)
+        self._set_dimensions_and_lenghts()
+
+    def output_type(self):
+        return np.dtype(self.data[0].dtype)
+
+    def __reduce__(self):
+        return _FeatureReader, (self.data, self.chunksize)
+
+def _splitColumns(matrix):
+    """
+    Split a 2D array into a list of contiguous 1D arrays, one per column.
+
+    Parameters
+    ==========
+    matrix : numpy.ndarray
+        2D array to split.
+
+    Returns
+    =======
+    columns : list
+        List of C-contiguous column arrays.
+    """
+    return [np.ascontiguousarray(matrix[:, i]) for i in range(matrix.shape[1])]
+
+if numba != None:
+    @njit(parallel=True, cache=True)
+    def _histogram2dKernel(x, y, xmin, xmax, ymin, ymax, bins, n_chunks):
+        """
+        Accumulate a 2D histogram over evenly spaced bins. Each chunk of the data is
+        counted into its own histogram plane, so parallel threads never write to
+        the same memory, and the planes are reduced at the end.
+        """
+        H = np.zeros((n_chunks, bins, bins))
+        xdx = (xmax-xmin)/bins
+        ydy = (ymax-ymin)/bins
+        n = x.size
+        chunk = (n+n_chunks-1)//n_chunks
+        for c in prange(n_chunks):
+            for i in range(c*chunk, min((c+1)*chunk, n)):
+                # Skip out of range (and nan) values
+                if not (x[i] >= xmin and x[i] <= xmax and y[i] >= ymin and y[i] <= ymax):
+                    continue
+                ix = min(int((x[i]-xmin)/xdx), bins-1)
+                iy = min(int((y[i]-ymin)/ydy), bins-1)
+                H[c, ix, iy] += 1
+        return H.sum(axis=0)
+
+def _histogram2d(input_data1, input_data2, bins):
+    """
+    Compute a 2D histogram of two coordinate arrays. Uses a parallel numba kernel
+    if numba is available and bins is an integer, otherwise falls back to
+    numpy.histogram2d. The returned values follow numpy.histogram2d, except that
+    nan values are ignored by the numba kernel.
+
+    Returns
+    =======
+    z : numpy.ndarray
+        Bin counts with shape (bins, bins).
+    x : numpy.ndarray
+        Bin edges along the first coordinate.
+    y : numpy.ndarray
+        Bin edges along the second coordinate.
+    """
+
+    if numba == None or not isinstance(bins, (int, np.integer)):
+        return np.histogram2d(input_data1, input_data2, bins=bins)
+
+    input_data1 = np.ascontiguousarray(input_data1)
+    input_data2 = np.ascontiguousarray(input_data2)
+
+    ranges = []
+    for d in [input_data1, input_data2]:
+        # nan values are left out of the range and skipped by the kernel
+        if np.all(np.isnan(d)):
+            raise ValueError('Cannot compute a histogram of only nan values.')
+        d_min, d_max = float(np.nanmin(d)), float(np.nanmax(d))
+        if d_min == d_max: # Same behaviour as numpy for empty ranges
+            d_min -= 0.5
+            d_max += 0.5
+        ranges.append((d_min, d_max))
+
+    (xmin, xmax), (ymin, ymax) = ranges
+    z = _histogram2dKernel(input_data1, input_data2, xmin, xmax, ymin, ymax, bins, numba.get_num_threads())
+    x = np.linspace(xmin, xmax, bins+1)
+    y = np.linspace(ymin, ymax, bins+1)
+
+    return z, x, y
+
+@functools.lru_cache(maxsize=None)
+def _gaussianWeights(sigma, truncate=4.0):
+    """
+    Get normalised 1D gaussian filter weights truncated at the same radius as
+    scipy.ndimage.gaussian_filter.
+    """
+    radius = int(truncate*float(sigma)+0.5)
+    weights = windows.gaussian(2*radius+1, sigma).astype(np.float32)
+    weights /= weights.sum()
+    return weights
+
+def _freeEnergySurface(input_data1, input_data2, bins=90, sigma=0.99):
+    """
+    Compute a smoothed free energy surface (in kcal/mol) from two sets of coordinates.
+
+    Parameters
+    ==========
+    input_data1 : numpy.ndarray
+        Coordinates along the X axis.
+    input_data2 : numpy.ndarray
+        Coordinates along the Y axis.
+    bins : int
+        Number of bins to divide each axis.
+    sigma : float
+        Sigma parameter for the gaussian filter, applied as two 1D convolutions.
+
+    Returns
+    =======
+    data : numpy.ndarray
+        Free energy surface with the X coordinate along the columns.
+    extent : list
+        Limits of the surface: [xmin, xmax, ymin, ymax]
+    """
+
+    z,x,y = _histogram2d(input_data1, input_data2, bins)
+    z = z.astype(np.float32)
+
+    # compute free energies (empty bins get the energy of a 0.1 count)
+    F = np.log(z, out=np.full_like(z, np.log(0.1)), where=z>0)
+    np.negative(F, out=F)
+    F *= 0.592
+    F -= F.min()
+
+    # Separable gaussian smoothing, the second pass is done in place
+    weights = _gaussianWeights(sigma)
+    data = convolve1d(F.T, weights, axis=0)
+    convolve1d(data, weights, axis=1, output=data)
+    extent = [x[0], x[-1], y[0], y[-1]]
+
+    return data, extent
+
 def _plot_Nice_PES(input_data1, input_data2, xlabel=None, ylabel=None, bins=90, sigma=0.99, title=False, size=1,
                    x_metric_line=None, y_metric_line=None, dpi=300, title_size=14, cmax=None, title_rotation=None,
                    title_location=None, title_x=0.5, title_y=1.02, show_xticks=False, show_yticks=False,
-                   xlim=None, ylim=None):
+                   xlim=None, ylim=None, surface=None):
 
     matplotlib.style.use("seaborn-paper")
 
-    plt.figure(figsize=(4*size, 3.3*size), dpi=dpi)
-
-    fig, ax = plt.subplots()
-
-    # alldata1=np.vstack(input_data1)
-    # alldata2=np.vstack(input_data2)
-
-    min1=np.min(input_data1)
-    max1=np.max(input_data1)
-    min2=np.min(input_data2)
-    max2=np.max(input_data2)
+    fig, ax = plt.subplots(figsize=(4*size, 3.3*size), dpi=dpi)
 
-    z,x,y = np.histogram2d(input_data1, input_data2, bins=bins)
-    z += 0.1
-
-    # compute free energies
-    F = -np.log(z)
-
-    # contour plot
-    extent = [x[0], x[-1], y[0], y[-1]]
+    # Use a precomputed (data, extent) surface if given
+    if isinstance(surface, type(None)):
+        surface = _freeEnergySurface(input_data1, input_data2, bins=bins, sigma=sigma)
+    data, extent = surface
 
     ax.spines['right'].set_visible(False)
     ax.spines['left'].set_visible(False)
@@ -517,8 +1015,6 @@ def _plot_Nice_PES(input_data1, input_data2, xlabel=None, ylabel=None, bins=90,
     else:
         ax.spines['left'].set_visible(True)
 
-    data = gaussian_filter((F.T)*0.592-np.min(F.T)*0.592, sigma)
-
     if cmax != None:
         levels=np.linspace(0, cmax, num=9)
     else: